@@ -1,7 +1,14 @@
+import re
 import sys
 import signal
-from pathlib import Path
+import time
+from collections import OrderedDict
+from bisect import bisect_left
 from difflib import SequenceMatcher
+from functools import lru_cache
+from itertools import accumulate
+from pathlib import Path
+from typing import Optional
 
 import fast_diff_match_patch
 
@@ -16,19 +23,23 @@ from PySide6.QtWidgets import (
 )
 from PySide6.QtCore import (
     Qt,
-    QTimer,
+    QEvent,
     QRect,
+    QPointF,
+    QRunnable,
+    QThreadPool,
     QSize,
     Slot,
     Signal,
+    SignalInstance,
 )
 from PySide6.QtGui import (
     QPainter,
     QColor,
     QPaintEvent,
+    QStaticText,
     QSyntaxHighlighter,
     QTextCharFormat,
-    QTextDocument,
     QFont,
     QTextCursor,
     QTextFormat,
@@ -36,26 +47,92 @@ from PySide6.QtGui import (
 
 from pygments import highlight
 from pygments.lexer import Lexer
-from pygments.lexers import PythonLexer, TextLexer, get_lexer_for_filename
-from pygments.token import Token
+from pygments.lexers import get_lexer_by_name, get_lexer_for_filename
+from pygments.token import STANDARD_TYPES, Token
 
 
 DIR = Path(__file__).parent
 DARK_STYLE_SHEET_FILE = DIR/"dark_mode.qss"
 # TODO: https://github.com/5yutan5/PyQtDarkTheme/blob/main/style/base.qss
 
-if DARK_STYLE_SHEET_FILE.exists():
-    DARK_STYLE_SHEET = DARK_STYLE_SHEET_FILE.read_text()
-else:
-    DARK_STYLE_SHEET = ""
+
+def load_style_sheet(path: Path = DARK_STYLE_SHEET_FILE) -> str:
+    """Read the style sheet on demand instead of at import time."""
+    if path.exists():
+        return path.read_text()
+    return ""
+
+
+@lru_cache(maxsize=None)
+def _get_lexer(name: str) -> Lexer:
+    """Lexers are stateless between get_tokens_unprocessed calls, so share them."""
+    return get_lexer_by_name(name)
+
+
+@lru_cache(maxsize=None)
+def _get_lexer_for_filename(filename: str) -> Lexer:
+    """
+    Same as _get_lexer, but guessed from the file name.
+
+    Highlighted lines are cached per lexer instance, so handing out the
+    same one lets all highlighters of the file type share that cache.
+    """
+    return get_lexer_for_filename(filename, stripall=True)
+
+
+def iterate_viewport_blocks(editor: QPlainTextEdit, rect: QRect = None):
+    """
+    Yield (block, block_top) for the blocks shown in the editor viewport.
+
+    Given a rect of the viewport, only the blocks it touches are yielded.
+    """
+    block = editor.firstVisibleBlock()
+    block_top = editor.contentOffset().y()
+    viewport_rect = editor.viewport().rect()
+    if rect is None:
+        rect = viewport_rect
+    top = rect.top()
+    bottom = min(rect.bottom(), viewport_rect.bottom())
+
+    while block.isValid() and block.isVisible():
+        if block_top > bottom:
+            break
+        block_bottom = block_top + editor.blockBoundingRect(block).height()
+        if block_bottom >= top:
+            yield block, block_top
+        block_top = block_bottom
+        block = block.next()
+
+
+TOKENIZE_CACHE_SIZE = 8192
 
 
 class PygmentsHighlighter(QSyntaxHighlighter):
-    def __init__(self, parent: QTextDocument, lexer: Lexer):
-        super().__init__(parent)
+    # Block states owned by the highlighter, placeholders use positive states
+    DEFERRED_STATE = -1  # Qt's default, the block was never highlighted
+    HIGHLIGHTED_STATE = 0
+
+    # Style tables, shared by all instances (e.g. both panels of a DiffEditor)
+    styles = None
+    _default_fmt = QTextCharFormat()  # Qt fills blocks with it anyway
+    _resolved = None
+
+    def __init__(self, editor: QPlainTextEdit, lexer: Lexer):
+        super().__init__(editor.document())
+        self.editor = editor
         self.lexer = lexer
-        # self.styles = self._default_styles()
-        self.styles = self._chromodynamics_styles()
+        # Set while the whole document is being replaced, see CodeEditor.setText
+        self.suspended = False
+
+        if PygmentsHighlighter.styles is None:
+            # PygmentsHighlighter.styles = self._default_styles()
+            PygmentsHighlighter.styles = self._chromodynamics_styles()
+            # Resolve the token hierarchy once, so the lookups are a single hit.
+            # Token types are immortal singletons, so their id() is a cheap key,
+            # unlike their hash which is recomputed as a tuple hash on each call
+            PygmentsHighlighter._resolved = {
+                id(token_type): self._find_best_style(token_type) for token_type in STANDARD_TYPES
+            }
 
     def _default_styles(self):
         return {
@@ -108,23 +185,127 @@ class PygmentsHighlighter(QSyntaxHighlighter):
             fmt.setFontItalic(True)
         return fmt
 
-    def _find_best_style(self, token_type) -> QTextCharFormat:
-        while token_type not in self.styles and token_type.parent:
+    @classmethod
+    def _find_best_style(cls, token_type) -> QTextCharFormat:
+        while token_type not in cls.styles and token_type.parent:
             token_type = token_type.parent
-        return self.styles.get(token_type) or QTextCharFormat()
+        return cls.styles.get(token_type) or cls._default_fmt
+
+    @classmethod
+    def _resolve(cls, token_type) -> QTextCharFormat:
+        fmt = cls._resolved.get(id(token_type))
+        if fmt is None:
+            fmt = cls._resolved[id(token_type)] = cls._find_best_style(token_type)
+        return fmt
+
+    # Keyed by (cls, lexer, text), so highlighters of both diff panels share
+    # the cache: the two documents are mostly the same lines
+    @classmethod
+    @lru_cache(maxsize=TOKENIZE_CACHE_SIZE)
+    def _format_ranges(cls, lexer: Lexer, text: str) -> tuple:
+        """
+        Lex one line into merged (start, length, format) ranges.
+
+        Neighbouring tokens often share a format, so each run is applied
+        only once. Whitespace looks the same in any format and extends the
+        current run, tokens with the default format are left out entirely.
+        """
+        ranges = []
+        # Locals for the per-token loop, attribute lookups add up here
+        append = ranges.append
+        resolved = cls._resolved
+        resolve = cls._resolve
+        default_fmt = cls._default_fmt
+
+        run_start = run_end = 0
+        run_fmt = None
+        for index, token_type, value in lexer.get_tokens_unprocessed(text):
+            contiguous = index == run_end and run_fmt is not None
+            if value.isspace():
+                if contiguous:
+                    run_end += len(value)
+                continue
+
+            fmt = resolved.get(id(token_type))
+            if fmt is None:
+                fmt = resolve(token_type)
+            if fmt is default_fmt:
+                continue
+            if fmt is run_fmt and contiguous:
+                run_end += len(value)
+                continue
+
+            if run_fmt is not None:
+                append((run_start, run_end - run_start, run_fmt))
+            run_start, run_end, run_fmt = index, index + len(value), fmt
+
+        if run_fmt is not None:
+            ranges.append((run_start, run_end - run_start, run_fmt))
+        return tuple(ranges)
+
+    def _is_in_viewport(self, block) -> bool:
+        first = self.editor.firstVisibleBlock().blockNumber()
+        line_height = max(1, self.editor.fontMetrics().height())
+        visible_lines = self.editor.viewport().height() // line_height + 1
+        return first <= block.blockNumber() <= first + visible_lines
 
     def highlightBlock(self, text: str) -> None:
-        for index, token_type, value in self.lexer.get_tokens_unprocessed(text):
-            self.setFormat(index, len(value), self._find_best_style(token_type))
+        if self.suspended:
+            return  # New blocks start in DEFERRED_STATE, nothing to mark
+        if self.currentBlockState() > 0:
+            # Placeholders keep their state, and their text is styled by
+            # the DiffEditor, there is no code to highlight
+            return
+
+        # Lexing blocks nobody can see is wasted work, so defer it
+        # until the block is scrolled into view (see CodeEditor)
+        if not self._is_in_viewport(self.currentBlock()):
+            self.setCurrentBlockState(self.DEFERRED_STATE)
+            return
+        self.setCurrentBlockState(self.HIGHLIGHTED_STATE)
+
+        # Qt overwrites the block layout formats with the ones collected
+        # through setFormat after this returns, so setFormat it is
+        setFormat = self.setFormat
+        for start, length, fmt in self._format_ranges(self.lexer, text):
+            setFormat(start, length, fmt)
+
+
+class TokenizeJob(QRunnable):
+    """Lexes lines in the background, so they are cached once scrolled into view."""
+
+    def __init__(self, lexer: Lexer, texts: list[str]):
+        super().__init__()
+        self.lexer = lexer
+        self.texts = texts
+
+    def run(self) -> None:
+        # Pygments holds the GIL, so this mostly fills idle time of the GUI thread
+        for text in self.texts:
+            PygmentsHighlighter._format_ranges(self.lexer, text)
 
 
 def count_digits(x: int) -> int:
-    return len(str(x)) if x > 0 else 1
+    # Line counts rarely exceed 5 digits, compare before allocating a string
+    if x < 10:
+        return 1
+    if x < 100:
+        return 2
+    if x < 1000:
+        return 3
+    if x < 10000:
+        return 4
+    if x < 100000:
+        return 5
+    return len(str(x))
 
 
 class LineNumbers(QWidget):
     LEFT_PADDING_PX = 15
     RIGHT_PADDING_PX = 5
+    # Enough for a few viewports of line numbers, scrolling through
+    # a long file shouldn't keep a prepared glyph run for every line
+    STATIC_TEXT_CACHE_SIZE = 2000
 
     def __init__(self, editor: QPlainTextEdit):
         super().__init__()
@@ -134,96 +315,171 @@ class LineNumbers(QWidget):
         self.line_count = 0
         self.collapsed_sections = []
 
-        # Cache for mapping blockNumber to original line number
-        self._line_number_cache = {}
-        self._cache_valid = False  # Flag to indicate if the cache needs to be rebuilt
-
-        self.editor.document().contentsChanged.connect(self._invalidate_cache)
+        # Original line number of each block, indexed by blockNumber. Only the
+        # prefix before the last edit stays valid, the rest is rebuilt on paint
+        self._line_number_cache: list[int] = []
+
+        # Pre-shaped line number glyphs and their widths, least recently
+        # painted first. Reset when our font changes
+        self._static_texts: OrderedDict[int, tuple[QStaticText, float]] = OrderedDict()
+        self._digit_width = self.fontMetrics().horizontalAdvance('9')
+        self._font_height = self.fontMetrics().height()
+        self._last_width_inputs = None
+        self._last_width = 0
+
+        # Editors don't wrap lines, so every block is equally tall.
+        # Measured lazily on paint, reset when the editor font changes
+        self._line_height = 0.0
+        # Colors derived from the editor palette, reset when it changes
+        self._bg_color = None
+        self._fg_color = None
+        self.editor.installEventFilter(self)
+
+        self.editor.document().contentsChange.connect(self._invalidate_cache)
         self.editor.document().contentsChanged.connect(self._update_line_count)
 
-    @Slot()
-    def _invalidate_cache(self):
-        self._cache_valid = False
+    def eventFilter(self, watched, event) -> bool:
+        if watched is self.editor:
+            if event.type() == QEvent.Type.FontChange:
+                self._line_height = 0.0
+            elif event.type() == QEvent.Type.PaletteChange:
+                self._bg_color = None
+        return super().eventFilter(watched, event)
+
+    def changeEvent(self, event: QEvent) -> None:
+        if event.type() == QEvent.Type.FontChange:
+            self._static_texts.clear()
+            self._digit_width = self.fontMetrics().horizontalAdvance('9')
+            self._font_height = self.fontMetrics().height()
+            self.update_width()
+        super().changeEvent(event)
+
+    def _static_text(self, line_number: int, painter: QPainter) -> tuple[QStaticText, float]:
+        static_texts = self._static_texts
+        cached = static_texts.get(line_number)
+        if cached is not None:
+            static_texts.move_to_end(line_number)
+        else:
+            static_text = QStaticText(str(line_number))
+            static_text.setTextFormat(Qt.TextFormat.PlainText)
+            static_text.prepare(painter.transform(), self.font())
+            cached = static_texts[line_number] = (static_text, static_text.size().width())
+            if len(static_texts) > self.STATIC_TEXT_CACHE_SIZE:
+                static_texts.popitem(last=False)
+        return cached
+
+    @Slot(int, int, int)
+    def _invalidate_cache(self, position: int, chars_removed: int, chars_added: int):
+        block_number = self.editor.document().findBlock(position).blockNumber()
+        del self._line_number_cache[max(block_number, 0):]
 
     @Slot()
     def _update_line_count(self):
         doc = self.editor.document()
         visible_lines = doc.blockCount()
-        hidden_lines = sum(len(section) - 1 for section in self.collapsed_sections)  # -1 for placeholder
+        hidden_lines = sum(
+            len(lines) - 1  # -1 for placeholder
+            for _, lines in filter(None, self.collapsed_sections)  # None once expanded
+        )
         self.line_count = visible_lines + hidden_lines
         self.update_width()
 
     def calculate_width(self) -> int:
-        digits = count_digits(self.line_count)
-        digit_width = self.fontMetrics().horizontalAdvance('9')
-        return self.LEFT_PADDING_PX + self.RIGHT_PADDING_PX + digit_width * digits
+        # Called on every edit, while the inputs rarely change
+        width_inputs = (self.line_count, self._digit_width)
+        if width_inputs != self._last_width_inputs:
+            digits = count_digits(self.line_count)
+            self._last_width = self.LEFT_PADDING_PX + self.RIGHT_PADDING_PX + self._digit_width * digits
+            self._last_width_inputs = width_inputs
+        return self._last_width
 
     def sizeHint(self) -> QSize:
         return QSize(self.calculate_width(), 0)
 
-    def _build_cache(self):
-        """Build the cache mapping blockNumber to original line number."""
-        self._line_number_cache.clear()
-        doc = self.editor.document()
-        block = doc.firstBlock()
-        original_line_number = 1  # 1-based line number
-
-        while block.isValid():
-            block_number = block.blockNumber()
-            self._line_number_cache[block_number] = original_line_number
-
-            # Update original_line_number for the next block
-            state = block.userState()
-            if state > 0:  # This is a placeholder
-                collapse_index = state - 1
-                if 0 <= collapse_index < len(self.collapsed_sections):
-                    hidden_lines = len(self.collapsed_sections[collapse_index])
-                    original_line_number += hidden_lines
-            else:
-                original_line_number += 1
-
-            block = block.next()
+    def _build_cache(self, last_block_number: int):
+        """Extend the cache mapping blockNumber to original line number."""
+        cache = self._line_number_cache
+        if len(cache) > last_block_number:
+            return
 
-        self._cache_valid = True
+        # Placeholders are the only blocks that don't show exactly one line,
+        # so the numbers follow from their positions without visiting blocks
+        spans = self._placeholder_spans()
+        start = len(cache)
+        if cache:
+            original_line_number = cache[-1] + spans.get(start - 1, 1)
+        else:
+            original_line_number = 1  # 1-based line number
+
+        append = cache.append
+        get_span = spans.get
+        for block_number in range(start, min(last_block_number + 1, self.editor.document().blockCount())):
+            append(original_line_number)
+            original_line_number += get_span(block_number, 1)
+
+    def _placeholder_spans(self) -> dict[int, int]:
+        """Map the blockNumber of each placeholder to the number of lines it hides."""
+        spans = {}
+        for collapse_index, cursor in self.editor.placeholders.items():
+            if 0 <= collapse_index < len(self.collapsed_sections):
+                section = self.collapsed_sections[collapse_index]
+                if section is not None:
+                    spans[cursor.blockNumber()] = len(section[1])
+        return spans
 
     def paintEvent(self, event: QPaintEvent) -> None:
         painter = QPainter(self)
+        rect = event.rect()
 
-        palette = self.editor.palette()
-        background_color = palette.color(palette.ColorRole.Base)
-        painter.fillRect(event.rect(), background_color.darker(110))
+        if self._bg_color is None:
+            palette = self.editor.palette()
+            self._bg_color = palette.color(palette.ColorRole.Base).darker(110)
+            self._fg_color = palette.color(palette.ColorRole.PlaceholderText)
+        painter.fillRect(rect, self._bg_color)
 
-        font_height = self.fontMetrics().height()
         font_width = self.width() - self.RIGHT_PADDING_PX
         block_top = self.editor.contentOffset().y()
 
-        painter.setPen(palette.color(palette.ColorRole.PlaceholderText))
+        painter.setPen(self._fg_color)
 
         # Get the first visible block
         block = self.editor.firstVisibleBlock()
         if not block.isValid():
             return
 
-        # Rebuild the cache if it's invalid
-        if not self._cache_valid:
-            self._build_cache()
+        if not self._line_height:
+            self._line_height = self.editor.blockBoundingRect(block).height()
+        line_height = self._line_height or self._font_height
+
+        # Often only a few rows are repainted (caret, single line edits),
+        # so jump straight to the first block inside the repainted area
+        skipped_blocks = int((rect.top() - block_top) // line_height)
+        if skipped_blocks > 0:
+            block = self.editor.document().findBlockByNumber(block.blockNumber() + skipped_blocks)
+            block_top += skipped_blocks * line_height
+        rect_bottom = rect.bottom()
+
+        # Bring the cache up to the last block to paint
+        cache = self._line_number_cache
+        self._build_cache(block.blockNumber() + int((rect_bottom - block_top) // line_height) + 1)
+
+        get_static_text = self._static_text
+        draw_static_text = painter.drawStaticText
 
         # Iterate over visible blocks, using the cache to look up line numbers
         while block.isValid() and block.isVisible():
-            if block_top > event.rect().bottom():
+            if block_top > rect_bottom:
                 break
 
             # If this block is a placeholder, skip drawing a line number
             state = block.userState()
             if state <= 0:  # Normal line, draw the line number
                 block_number = block.blockNumber()
-                original_line_number = self._line_number_cache.get(block_number, 1)  # Fallback to 1 if not found
-                painter.drawText(
-                    0, block_top, font_width, font_height,
-                    Qt.AlignRight, str(original_line_number),
-                )
+                original_line_number = cache[block_number] if block_number < len(cache) else 1  # Fallback to 1 if not found
+                static_text, text_width = get_static_text(original_line_number, painter)
+                draw_static_text(QPointF(font_width - text_width, block_top), static_text)
 
-            block_top += self.editor.blockBoundingRect(block).height()
+            block_top += line_height
             block = block.next()
 
     @Slot(QRect, int)
@@ -236,12 +492,33 @@ class LineNumbers(QWidget):
     @Slot()
     def update_width(self):
         width = self.calculate_width()
-        self.setFixedWidth(width)
+        if width != self.minimumWidth():  # Resizing relayouts the CodeEditor
+            self.setFixedWidth(width)
 
 
 class CollapsiblePlainTextEdit(QPlainTextEdit):
     placeholderClicked = Signal(int)
 
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        # Collapse index -> cursor at the start of its placeholder block, set
+        # by the DiffEditor. Unlike block numbers, cursors follow the edits
+        self.placeholders: dict[int, QTextCursor] = {}
+        # The same cursors in document order, for bisecting
+        self._placeholder_cursors: list[QTextCursor] = []
+
+    def set_placeholders(self, placeholders: dict[int, QTextCursor]):
+        self.placeholders = placeholders
+        # Collapse indices go top to bottom, and cursors never pass each other
+        self._placeholder_cursors = list(placeholders.values())
+
+    def remove_placeholder(self, collapse_index: int) -> Optional[QTextCursor]:
+        """Forget the placeholder and return its cursor, None if there is none."""
+        cursor = self.placeholders.pop(collapse_index, None)
+        if cursor is not None:
+            self._placeholder_cursors.remove(cursor)
+        return cursor
+
     def mousePressEvent(self, event):
         cursor = self.cursorForPosition(event.position().toPoint())
         block = cursor.block()
@@ -256,12 +533,23 @@ class CollapsiblePlainTextEdit(QPlainTextEdit):
             return False
         start = cursor.selectionStart()
         end = cursor.selectionEnd()
-        block = self.document().findBlock(start)
-        while block.isValid() and block.position() < end:
-            if block.userState() > 0:
+
+        # Bisect right of the selection start, only the placeholders around
+        # the selection are looked at. The positions are read from the cursors
+        # as needed, since they move with the edits
+        placeholders = self._placeholder_cursors
+        index, hi = 0, len(placeholders)
+        while index < hi:
+            mid = (index + hi) // 2
+            if placeholders[mid].position() <= start:
+                index = mid + 1
+            else:
+                hi = mid
+        if index > 0:  # The placeholder starting before may reach into the selection
+            block = placeholders[index - 1].block()
+            if block.position() + block.length() > start:
                 return True
-            block = block.next()
-        return False
+        return index < len(placeholders) and placeholders[index].position() < end
 
     def keyPressEvent(self, event):
         cursor = self.textCursor()
@@ -299,7 +587,14 @@ class CollapsiblePlainTextEdit(QPlainTextEdit):
         super().insertFromMimeData(source)
 
 
+# Characters that don't survive setPlainText + toPlainText unchanged: line
+# and paragraph separators, no-break spaces and Qt's frame markers
+_PLAIN_TEXT_ALTERED_CHARS = re.compile("[\r\u2028\u2029\xa0\ufdd0\ufdd1]")
+
+
 class CodeEditor(QWidget):
+    PREFETCH_BLOCKS = 200
+
     def __init__(self, parent=None):
         super().__init__(parent)
 
@@ -310,6 +605,14 @@ class CodeEditor(QWidget):
         self.line_numbers = LineNumbers(self.editor)
 
         self.highlighter = None
+        self._highlighting_viewport = False
+
+        # Bumped on every edit of the text. Unlike QTextDocument.revision()
+        # and textChanged, contentsChange is not emitted by the highlighter
+        self.text_revision = 0
+        self._plain_text = None
+        self._plain_text_revision = -1
+        self.editor.document().contentsChange.connect(self._bump_text_revision)
 
         layout = QHBoxLayout(self)
         layout.setSpacing(0)
@@ -319,22 +622,95 @@ class CodeEditor(QWidget):
 
         self.editor.updateRequest.connect(self.line_numbers.update_with_editor)
         self.editor.blockCountChanged.connect(self.line_numbers.update_width)
+        # Scrolling and resizing both go through updateRequest
+        self.editor.updateRequest.connect(self._highlight_viewport)
 
         self.line_numbers.update_width()
 
-    def set_lexer(self, lexer: Lexer):
-        """Creates or replaces the syntax highlighter."""
+    @Slot(QRect, int)
+    def _highlight_viewport(self, rect: QRect = None, dy: int = 0):
+        """Highlight the visible blocks which were deferred by the highlighter."""
+        # Rehighlighting a block repaints it, which re-emits updateRequest
+        if self.highlighter is None or self._highlighting_viewport:
+            return
+
+        self._highlighting_viewport = True
+        try:
+            last_block = None
+            highlighted_any = False
+            # Caret blinks and edits only update a few rows, look at just those
+            for block, _ in iterate_viewport_blocks(self.editor, rect):
+                last_block = block
+                if block.userState() == PygmentsHighlighter.DEFERRED_STATE:
+                    self.highlighter.rehighlightBlock(block)
+                    highlighted_any = True
+        finally:
+            self._highlighting_viewport = False
+
+        # Scrolled into unhighlighted territory, get ahead of the next scroll
+        if highlighted_any and last_block is not None:
+            self._prefetch_highlighting(last_block.next())
+
+    def _prefetch_highlighting(self, block):
+        """Lex the deferred blocks following the given one on a worker thread."""
+        texts = []
+        for _ in range(self.PREFETCH_BLOCKS):
+            if not block.isValid():
+                break
+            if block.userState() == PygmentsHighlighter.DEFERRED_STATE:
+                texts.append(block.text())
+            block = block.next()
+
+        if texts:
+            QThreadPool.globalInstance().start(TokenizeJob(self.highlighter.lexer, texts))
+
+    @Slot(int, int, int)
+    def _bump_text_revision(self, position: int, chars_removed: int, chars_added: int):
+        self.text_revision += 1
+
+    def plain_text(self) -> str:
+        """toPlainText, copied out of the document only once per revision."""
+        if self._plain_text_revision != self.text_revision:
+            self._plain_text = self.editor.toPlainText()
+            self._plain_text_revision = self.text_revision
+        return self._plain_text
+
+    def set_lexer(self, lexer: Lexer, rehighlight: bool = True):
+        """
+        Creates or replaces the syntax highlighter.
+
+        Pass rehighlight=False when the text is about to be replaced anyway,
+        setText highlights the new one.
+        """
         if self.highlighter:
-            # Clean up the old one to be safe
-            self.highlighter.setDocument(None)
-            self.highlighter.setParent(None)
+            # Swapping the lexer keeps the highlighter attached, re-attaching
+            # one to a document with text makes Qt schedule a full rehighlight
+            self.highlighter.lexer = lexer
+            if rehighlight:
+                self.highlighter.rehighlight()
+            return
 
-        self.highlighter = PygmentsHighlighter(self.editor.document(), lexer)
-        # Re-highlighting is necessary if text is already present
-        self.highlighter.rehighlight()
+        self.highlighter = PygmentsHighlighter(self.editor, lexer)
+        if not self.editor.document().isEmpty():
+            # Also takes the place of the rehighlight scheduled by Qt
+            self.highlighter.rehighlight()
 
     def setText(self, text: str):
-        self.editor.setPlainText(text)
+        # setPlainText makes the highlighter visit every new block, only to
+        # find out that most are off screen. Skip that pass entirely and
+        # highlight just the viewport once the text is in
+        if self.highlighter:
+            self.highlighter.suspended = True
+        try:
+            self.editor.setPlainText(text)
+        finally:
+            if self.highlighter:
+                self.highlighter.suspended = False
+        if _PLAIN_TEXT_ALTERED_CHARS.search(text) is None:
+            # The document holds exactly this text, no need to copy it back out
+            self._plain_text = text
+            self._plain_text_revision = self.text_revision
+        self._highlight_viewport()
         return self
 
     def setReadOnly(self, value: bool = True):
@@ -344,8 +720,206 @@ class CodeEditor(QWidget):
         self.editor.setExtraSelections(highlights)
 
 
+# Every code point but the surrogates can stand for a line
+_MAX_LINE_CODES = 0x110000 - 0x800
+
+
+def _encode_lines(lines: list[str], codes: dict[str, str]) -> Optional[str]:
+    """
+    Map every distinct line to its own character, skipping surrogates.
+    None if there are more distinct lines than characters.
+    """
+    encoded = []
+    for line in lines:
+        code = codes.get(line)
+        if code is None:
+            index = len(codes)
+            if index >= _MAX_LINE_CODES:
+                return None
+            code = codes[line] = chr(index if index < 0xD800 else index + 0x800)
+        encoded.append(code)
+    return "".join(encoded)
+
+
+SEQUENCE_MATCHER_MAX_LINES = 2000
+
+
+def _common_prefix_length(a, b) -> int:
+    """Length of the common prefix of two sequences, compared in halving slices."""
+    lo, hi = 0, min(len(a), len(b))
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[lo:mid] == b[lo:mid]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def _common_suffix_length(a, b, limit: int) -> int:
+    """Length of the common suffix of two sequences, up to limit."""
+    len_a, len_b = len(a), len(b)
+    lo, hi = 0, limit
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if a[len_a - mid : len_a - lo] == b[len_b - mid : len_b - lo]:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
+
+
+def diff_lines(old_lines: list[str], new_lines: list[str]) -> list[tuple[str, int, int, int, int]]:
+    """
+    Line level opcodes, in the same format as SequenceMatcher.get_opcodes().
+
+    Edits tend to be small compared to the files, so the common head and
+    tail are cut off first and only the lines in between are diffed.
+    """
+    prefix = _common_prefix_length(old_lines, new_lines)
+    suffix = _common_suffix_length(old_lines, new_lines, min(len(old_lines), len(new_lines)) - prefix)
+    old_end = len(old_lines) - suffix
+    new_end = len(new_lines) - suffix
+
+    opcodes = []
+    if prefix:
+        opcodes.append(('equal', 0, prefix, 0, prefix))
+    for tag, i1, i2, j1, j2 in _diff_lines(old_lines[prefix:old_end], new_lines[prefix:new_end]):
+        i1, i2, j1, j2 = i1 + prefix, i2 + prefix, j1 + prefix, j2 + prefix
+        if tag == 'equal' and opcodes and opcodes[-1][0] == 'equal':
+            i1, j1 = opcodes.pop()[1::2]
+        opcodes.append((tag, i1, i2, j1, j2))
+    if suffix:
+        if opcodes and opcodes[-1][0] == 'equal':
+            _, i1, _, j1, _ = opcodes.pop()
+        else:
+            i1, j1 = old_end, new_end
+        opcodes.append(('equal', i1, len(old_lines), j1, len(new_lines)))
+    return opcodes
+
+
+def _diff_lines(old_lines: list[str], new_lines: list[str]) -> list[tuple[str, int, int, int, int]]:
+    """
+    Lines are encoded as characters, so the native fast_diff_match_patch
+    can diff them instead of the pure Python difflib. Small inputs still go
+    through difflib, which is fast enough there and aligns lines better
+    """
+    if len(old_lines) + len(new_lines) < SEQUENCE_MATCHER_MAX_LINES:
+        return SequenceMatcher(None, old_lines, new_lines, autojunk=False).get_opcodes()
+
+    codes = {}
+    old_encoded = _encode_lines(old_lines, codes)
+    new_encoded = _encode_lines(new_lines, codes) if old_encoded is not None else None
+    if new_encoded is None:
+        # Over a million distinct lines, that many would take ages to align
+        # anyway, so they are simply all replaced
+        if not old_lines:
+            return [('insert', 0, 0, 0, len(new_lines))]
+        if not new_lines:
+            return [('delete', 0, len(old_lines), 0, 0)]
+        return [('replace', 0, len(old_lines), 0, len(new_lines))]
+
+    diff = fast_diff_match_patch.diff(
+        old_encoded, new_encoded, timelimit=0.1, checklines=False, counts_only=True,
+    )
+
+    opcodes = []
+    i = j = 0
+    for op, length in diff:
+        if op == '=':
+            opcodes.append(('equal', i, i + length, j, j + length))
+            i += length
+            j += length
+        elif op == '-':
+            opcodes.append(('delete', i, i + length, j, j))
+            i += length
+        elif opcodes and opcodes[-1][0] == 'delete':  # '-' followed by '+'
+            _, i1, i2, j1, _ = opcodes[-1]
+            opcodes[-1] = ('replace', i1, i2, j1, j + length)
+            j += length
+        else:
+            opcodes.append(('insert', i, i, j, j + length))
+            j += length
+    return opcodes
+
+
+_ASTRAL_CHAR = re.compile("[\U00010000-\U0010FFFF]")
+
+
+def _qt_position_mapper(text: str):
+    """
+    Map code point offsets into the text to Qt's UTF-16 based positions.
+
+    Characters outside the BMP take two positions in Qt. None if the text
+    has none of them, then offsets and positions are the same.
+    """
+    astral = [match.start() for match in _ASTRAL_CHAR.finditer(text)]
+    if not astral:
+        return None
+    return lambda offset: offset + bisect_left(astral, offset)
+
+
+def diff_ranges(old_text: str, new_text: str) -> tuple[list[list[int]], list[list[int]]]:
+    """The [start, end) Qt positions of the deleted and of the added parts of the texts."""
+    opcodes = fast_diff_match_patch.diff(old_text, new_text, timelimit=0.1, checklines=True, counts_only=True)
+
+    # Offsets of the changed ranges, a '-' directly followed by a '+' is
+    # a modification and gets a range in both texts like any other run.
+    # Runs that end up next to each other are merged into one range
+    old_ranges = []
+    new_ranges = []
+    i = j = 0
+    old_end = new_end = -1  # End of the last range, to merge the next one
+    for op, length in opcodes:
+        if op == '=':
+            i += length
+            j += length
+        elif op == '-':
+            if i == old_end:
+                old_ranges[-1][1] = old_end = i + length
+            else:
+                old_end = i + length
+                old_ranges.append([i, old_end])
+            i = old_end
+        else:  # '+'
+            if j == new_end:
+                new_ranges[-1][1] = new_end = j + length
+            else:
+                new_end = j + length
+                new_ranges.append([j, new_end])
+            j = new_end
+
+    # The diff counts code points, Qt positions count UTF-16 units
+    for text, ranges in ((old_text, old_ranges), (new_text, new_ranges)):
+        to_position = _qt_position_mapper(text)
+        if to_position is not None:
+            for pair in ranges:
+                pair[0], pair[1] = to_position(pair[0]), to_position(pair[1])
+    return old_ranges, new_ranges
+
+
+class DiffJob(QRunnable):
+    """Diffs two texts on a worker thread, the ranges are emitted with the given seq."""
+
+    def __init__(self, seq: int, old_text: str, new_text: str, finished: SignalInstance):
+        super().__init__()
+        self.seq = seq
+        self.old_text = old_text
+        self.new_text = new_text
+        self.finished = finished
+
+    def run(self) -> None:
+        # Everything up to the selections is done here, off the GUI thread
+        old_ranges, new_ranges = diff_ranges(self.old_text, self.new_text)
+        # Queued to the GUI thread, since the DiffEditor lives there
+        self.finished.emit(self.seq, old_ranges, new_ranges)
+
+
 class DiffEditor(QWidget):
-    UPDATE_DELAY_MS = 300
+    UPDATE_DELAY_MS = 60  # Pause in typing that triggers a diff
+    UPDATE_DEADLINE_MS = 400  # Longest wait for a diff while typing on
+    MAX_UPDATE_DELAY_MS = 2000
+    UPDATE_DELAY_CHARS_PER_MS = 2000  # Bigger documents take longer to diff
     COLLAPSE_THRESHOLD_LINES = 5
     COLLAPSE_CONTEXT_LINES = 3
 
@@ -354,6 +928,8 @@ class DiffEditor(QWidget):
 
     PLACEHOLDER_COLOR = QColor(60, 60, 60)
 
+    diffFinished = Signal(int, object, object)
+
     def __init__(self, parent=None):
         super().__init__(parent)
 
@@ -361,6 +937,13 @@ class DiffEditor(QWidget):
         self.new = CodeEditor()
         self.old.setReadOnly(True)
 
+        # Selections copy their format, so the same ones are handed to all
+        self._add_format = self._create_line_format(self.ADD_COLOR)
+        self._del_format = self._create_line_format(self.DEL_COLOR)
+        self._placeholder_format = self._create_line_format(self.PLACEHOLDER_COLOR)
+        # Style the placeholder text itself to look different
+        self._placeholder_text_format = self._create_placeholder_text_format()
+
         self._sync_scroll_bars()
 
         splitter = QSplitter(Qt.Horizontal)
@@ -371,29 +954,89 @@ class DiffEditor(QWidget):
         layout.setContentsMargins(0, 0, 0, 0)
         layout.addWidget(splitter)
 
-        self._update_diff_when(self.new.editor.textChanged)
+        # Not textChanged, which highlighting blocks emits as well
+        self._update_diff_when(self.new.editor.document().contentsChange)
         self.old.editor.placeholderClicked.connect(self.expand_section)
         self.new.editor.placeholderClicked.connect(self.expand_section)
-        self.set_diff_text("", "", TextLexer())
+        self._last_texts = None
+        self._placeholder_highlights: dict[CodeEditor, list[QTextEdit.ExtraSelection]] = {self.old: [], self.new: []}
+        # Only the result of the latest DiffJob is applied. They get a thread
+        # of their own, so that outdated ones can be dropped before they start
+        self._diff_seq = 0
+        self._diff_pool = QThreadPool(self)
+        self._diff_pool.setMaxThreadCount(1)
+        self._diff_revisions = None
+        self.diffFinished.connect(self._apply_diff)
+        self.set_diff_text("", "", _get_lexer("text"))
 
     def _sync_scroll_bars(self):
         old_scroll_bar = self.old.editor.verticalScrollBar()
         new_scroll_bar = self.new.editor.verticalScrollBar()
-
-        new_scroll_bar.valueChanged.connect(old_scroll_bar.setValue)
-        old_scroll_bar.valueChanged.connect(new_scroll_bar.setValue)
+        self._syncing_scroll = False
+
+        # Without the guard every sync would bounce back through the other bar
+        def sync_to(scroll_bar):
+            def sync(value: int):
+                if self._syncing_scroll:
+                    return
+                self._syncing_scroll = True
+                try:
+                    scroll_bar.setValue(value)
+                finally:
+                    self._syncing_scroll = False
+            return sync
+
+        new_scroll_bar.valueChanged.connect(sync_to(old_scroll_bar))
+        old_scroll_bar.valueChanged.connect(sync_to(new_scroll_bar))
 
     def _update_diff_when(self, event):
-        self.update_timer = QTimer(self)
-        self.update_timer.setSingleShot(True)
-        self.update_timer.setInterval(self.UPDATE_DELAY_MS)
-        self.update_timer.timeout.connect(self.update_diff)
+        self._update_timer_id = 0
+        self._first_change_time = 0.0
+        self._last_change_time = 0.0
+        event.connect(self._schedule_update)
 
-        event.connect(self.update_timer.start)
+    @Slot()
+    def _schedule_update(self):
+        # Restarting a timer on every keystroke is a call into Qt each time,
+        # instead only note the time and let timerEvent re-arm if needed
+        self._last_change_time = time.monotonic()
+        if not self._update_timer_id:
+            self._first_change_time = self._last_change_time
+            self._update_timer_id = self.startTimer(self._update_delay_ms())
+
+    def _update_delay_ms(self) -> int:
+        # Wait longer between diffs of big documents, so that they don't
+        # pile up while typing. characterCount doesn't copy the text
+        chars = self.new.editor.document().characterCount()
+        return min(self.MAX_UPDATE_DELAY_MS, self.UPDATE_DELAY_MS + chars // self.UPDATE_DELAY_CHARS_PER_MS)
+
+    def _cancel_scheduled_update(self):
+        if self._update_timer_id:
+            self.killTimer(self._update_timer_id)
+            self._update_timer_id = 0
+
+    def timerEvent(self, event):
+        if event.timerId() != self._update_timer_id:
+            return super().timerEvent(event)
+
+        self._cancel_scheduled_update()
+        # Diff on a short pause in typing, or once the deadline counted from
+        # the first edit of the burst passes, whichever comes first
+        delay_ms = self._update_delay_ms()
+        now = time.monotonic()
+        remaining_ms = min(
+            delay_ms - (now - self._last_change_time) * 1000,
+            max(self.UPDATE_DEADLINE_MS, delay_ms) - (now - self._first_change_time) * 1000,
+        )
+        if remaining_ms >= 1:  # Edited since the timer was started
+            self._update_timer_id = self.startTimer(int(remaining_ms))
+        else:
+            self.update_diff()
 
     def set_diff_text(self, old: str, new: str, lexer: Lexer):
-        self.old.set_lexer(lexer)
-        self.new.set_lexer(lexer)
+        # The texts are replaced below, which highlights them
+        self.old.set_lexer(lexer, rehighlight=False)
+        self.new.set_lexer(lexer, rehighlight=False)
 
         self.original_old = old.splitlines(keepends=True)
         self.original_new = new.splitlines(keepends=True)
@@ -402,69 +1045,102 @@ class DiffEditor(QWidget):
         self.old.line_numbers.update_width()
         self.new.line_numbers.update_width()
 
-        matcher = SequenceMatcher(None, self.original_old, self.original_new, autojunk=False)
-
-        self.collapsed_sections = []  # List of original lines for each collapsed section
+        # (joined text, original lines) of each collapsed section, None once expanded
+        self.collapsed_sections = []
         self.old.line_numbers.collapsed_sections = self.collapsed_sections
         self.new.line_numbers.collapsed_sections = self.collapsed_sections
         placeholders_to_set = {self.old.editor: [], self.new.editor: []}
 
-        displayed_old_parts = []
-        displayed_new_parts = []
-
-        old_line_num = 0
-        new_line_num = 0
-
-        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
-            num_equal_lines = i2 - i1
-            if tag == 'equal' and num_equal_lines > self.COLLAPSE_THRESHOLD_LINES:
-                num_hidden_lines = num_equal_lines - 2 * self.COLLAPSE_CONTEXT_LINES
-                placeholder = f"[{num_hidden_lines} lines hidden, click to expand]\n"
-                collapse_index = len(self.collapsed_sections)
-
-                # Store the middle part that is actually collapsed
-                self.collapsed_sections.append(
-                    self.original_old[i1 + self.COLLAPSE_CONTEXT_LINES : i2 - self.COLLAPSE_CONTEXT_LINES]
-                )
-
-                # Show top context
-                displayed_old_parts.extend(self.original_old[i1 : i1 + self.COLLAPSE_CONTEXT_LINES])
-                displayed_new_parts.extend(self.original_new[j1 : j1 + self.COLLAPSE_CONTEXT_LINES])
-
-                # Add placeholder
-                displayed_old_parts.append(placeholder)
-                displayed_new_parts.append(placeholder)
-
-                # Show bottom context
-                displayed_old_parts.extend(self.original_old[i2 - self.COLLAPSE_CONTEXT_LINES : i2])
-                displayed_new_parts.extend(self.original_new[j2 - self.COLLAPSE_CONTEXT_LINES : j2])
-
-                # Record where to put the userState for the placeholder line
-                placeholder_line_in_old = old_line_num + self.COLLAPSE_CONTEXT_LINES
-                placeholder_line_in_new = new_line_num + self.COLLAPSE_CONTEXT_LINES
-                placeholders_to_set[self.old.editor].append((placeholder_line_in_old, collapse_index))
-                placeholders_to_set[self.new.editor].append((placeholder_line_in_new, collapse_index))
-
-                # Update line counts for the next iteration
-                lines_added_to_display = 2 * self.COLLAPSE_CONTEXT_LINES + 1
-                old_line_num += lines_added_to_display
-                new_line_num += lines_added_to_display
-            else:
-                displayed_old_parts.extend(self.original_old[i1:i2])
-                displayed_new_parts.extend(self.original_new[j1:j2])
-                old_line_num += (i2 - i1)
-                new_line_num += (j2 - j1)
-
-        self.old.setText(''.join(displayed_old_parts))
-        self.new.setText(''.join(displayed_new_parts))
-
+        opcodes = diff_lines(self.original_old, self.original_new)
+        collapses = any(
+            tag == 'equal' and i2 - i1 > self.COLLAPSE_THRESHOLD_LINES for tag, i1, i2, _, _ in opcodes
+        )
+        if not collapses:
+            # The texts are shown as they are, no need to rebuild them
+            displayed_old, displayed_new = old, new
+        else:
+            # Offsets of the line starts, so that runs of lines are sliced out of
+            # the texts in one piece instead of being gathered line by line
+            old_starts = list(accumulate(map(len, self.original_old), initial=0))
+            new_starts = list(accumulate(map(len, self.original_new), initial=0))
+            context = self.COLLAPSE_CONTEXT_LINES
+
+            displayed_old_parts = []
+            displayed_new_parts = []
+            # Bound once, the loop runs for every opcode of the diff
+            old_append = displayed_old_parts.append
+            new_append = displayed_new_parts.append
+            old_placeholders_append = placeholders_to_set[self.old.editor].append
+            new_placeholders_append = placeholders_to_set[self.new.editor].append
+            sections_append = self.collapsed_sections.append
+
+            old_line_num = 0
+            new_line_num = 0
+
+            for tag, i1, i2, j1, j2 in opcodes:
+                num_equal_lines = i2 - i1
+                if tag == 'equal' and num_equal_lines > self.COLLAPSE_THRESHOLD_LINES:
+                    num_hidden_lines = num_equal_lines - 2 * context
+                    placeholder = f"[{num_hidden_lines} lines hidden, click to expand]\n"
+                    collapse_index = len(self.collapsed_sections)
+
+                    # Store the middle part that is actually collapsed, sliced
+                    # right away so that expanding it is just the document edit
+                    sections_append((
+                        old[old_starts[i1 + context] : old_starts[i2 - context]],
+                        self.original_old[i1 + context : i2 - context],
+                    ))
+
+                    # Show top context
+                    old_append(old[old_starts[i1] : old_starts[i1 + context]])
+                    new_append(new[new_starts[j1] : new_starts[j1 + context]])
+
+                    # Add placeholder
+                    old_append(placeholder)
+                    new_append(placeholder)
+
+                    # Show bottom context
+                    old_append(old[old_starts[i2 - context] : old_starts[i2]])
+                    new_append(new[new_starts[j2 - context] : new_starts[j2]])
+
+                    # Record where to put the userState for the placeholder line
+                    placeholder_line_in_old = old_line_num + context
+                    placeholder_line_in_new = new_line_num + context
+                    old_placeholders_append((placeholder_line_in_old, collapse_index))
+                    new_placeholders_append((placeholder_line_in_new, collapse_index))
+
+                    # Update line counts for the next iteration
+                    lines_added_to_display = 2 * context + 1
+                    old_line_num += lines_added_to_display
+                    new_line_num += lines_added_to_display
+                else:
+                    old_append(old[old_starts[i1] : old_starts[i2]])
+                    new_append(new[new_starts[j1] : new_starts[j2]])
+                    old_line_num += (i2 - i1)
+                    new_line_num += (j2 - j1)
+
+            displayed_old = ''.join(displayed_old_parts)
+            displayed_new = ''.join(displayed_new_parts)
+
+        self.old.setText(displayed_old)
+        self.new.setText(displayed_new)
+
+        # The block numbers of the placeholders were recorded while building
+        # the texts. Editors don't wrap lines, so line and block numbers are
+        # the same, and finding a block by its number is a lookup in Qt's
+        # block tree, much cheaper than walking all blocks from Python
         for editor, placeholders in placeholders_to_set.items():
             doc = editor.document()
-            for line_num, collapse_index in placeholders:
-                block = doc.findBlockByLineNumber(line_num)
+            cursors = {}
+            for block_number, collapse_index in placeholders:
+                block = doc.findBlockByNumber(block_number)
                 if block.isValid():
                     block.setUserState(collapse_index + 1)
+                    cursors[collapse_index] = QTextCursor(block)
+            editor.set_placeholders(cursors)
 
+        self._last_texts = None  # The documents were rebuilt, highlight them anew
+        self._refresh_placeholder_highlights()
         self.update_diff()
         return self
 
@@ -474,127 +1150,153 @@ class DiffEditor(QWidget):
         fmt.setFontItalic(True)
         return fmt
 
+    def _create_line_format(self, color: QColor) -> QTextCharFormat:
+        fmt = QTextCharFormat()
+        fmt.setBackground(color)
+        fmt.setProperty(QTextFormat.FullWidthSelection, True)
+        return fmt
+
+    def _refresh_placeholder_highlights(self):
+        # The placeholders only change on set_diff_text and expanding, and
+        # the cursors of their selections follow the edits in between
+        if not self.old.editor.placeholders and not self.new.editor.placeholders:
+            self._placeholder_highlights = {self.old: [], self.new: []}
+            return
+        self._placeholder_highlights = {
+            editor: self._get_placeholder_highlights(editor) for editor in (self.old, self.new)
+        }
+
     def _get_placeholder_highlights(self, editor: CodeEditor) -> list[QTextEdit.ExtraSelection]:
         selections = []
-        placeholder_format = QTextCharFormat()
-        placeholder_format.setBackground(self.PLACEHOLDER_COLOR)
-        placeholder_format.setProperty(QTextFormat.FullWidthSelection, True)
+        placeholder_format = self._placeholder_format
+        text_format = self._placeholder_text_format
+
+        # Only the placeholders are visited, not every block of the document
+        for placeholder_cursor in editor.editor.placeholders.values():
+            block = placeholder_cursor.block()
+
+            # Apply special background
+            selection = QTextEdit.ExtraSelection()
+            selection.format = placeholder_format
+            selection.cursor = QTextCursor(block)
+            selections.append(selection)
+
+            # Apply special text format
+            text_selection = QTextEdit.ExtraSelection()
+            text_selection.format = text_format
+            cursor = QTextCursor(block)
+            cursor.select(QTextCursor.SelectionType.LineUnderCursor)
+            text_selection.cursor = cursor
+            selections.append(text_selection)
 
-        # Style the text itself to look different
-        text_format = self._create_placeholder_text_format()
+        return selections
 
-        block = editor.editor.document().firstBlock()
-        while block.isValid():
-            if block.userState() > 0:
-                # Apply special background
-                selection = QTextEdit.ExtraSelection()
-                selection.format = placeholder_format
-                selection.cursor = QTextCursor(block)
-                selections.append(selection)
-
-                # Apply special text format
-                text_selection = QTextEdit.ExtraSelection()
-                text_selection.format = text_format
-                cursor = QTextCursor(block)
-                cursor.select(QTextCursor.SelectionType.LineUnderCursor)
-                text_selection.cursor = cursor
-                selections.append(text_selection)
+    def _diff_highlights(
+        self, editor: CodeEditor, ranges: list[list[int]], diff_format: QTextCharFormat,
+    ) -> list[QTextEdit.ExtraSelection]:
+        doc = editor.editor.document()
 
-            block = block.next()
-        return selections
+        # Selections store a copy of the cursor, so one is enough for all
+        cursor = QTextCursor(doc)
+        set_position = cursor.setPosition
+        keep_anchor = QTextCursor.MoveMode.KeepAnchor
+        ExtraSelection = QTextEdit.ExtraSelection
 
-    def _one_diff_highlight(self, length: int, color, cursor):
-        selection = QTextEdit.ExtraSelection()
-        selection.format.setBackground(color)
-        selection.format.setProperty(QTextFormat.FullWidthSelection, True)
-        selection.cursor = cursor
-        selection.cursor.setPosition(cursor.position())
-        selection.cursor.movePosition(QTextCursor.NextCharacter, QTextCursor.KeepAnchor, length)
-        cursor.movePosition(QTextCursor.NextCharacter, QTextCursor.MoveAnchor, length)
-        return selection
+        selections = []
+        append = selections.append
+        for start, end in ranges:
+            selection = ExtraSelection()
+            selection.format = diff_format
+            set_position(start)
+            set_position(end, keep_anchor)
+            selection.cursor = cursor
+            append(selection)
+        return selections
 
     @Slot()
     def update_diff(self):
-        old_text = self.old.editor.toPlainText()
-        new_text = self.new.editor.toPlainText()
-
-        opcodes = fast_diff_match_patch.diff(old_text, new_text, timelimit=0.1, checklines=True, counts_only=True)
-
-        old_highlights = []
-        new_highlights = []
+        # Programmatic edits (set_diff_text, expanding) call us right away,
+        # the run they scheduled through textChanged would be redundant
+        self._cancel_scheduled_update()
+
+        # The old text only changes on expanding, so it is mostly cached
+        old_text = self.old.plain_text()
+        new_text = self.new.plain_text()
+
+        # Nothing to do if the texts are the same as on the last run.
+        # Comparing strings checks their identity and lengths first, so
+        # cached or resized texts cost nothing here, unlike hashing them
+        if (old_text, new_text) == self._last_texts:
+            # Possibly edited and undone since, the diff of these texts that
+            # may still be running fits them as they are now
+            self._diff_revisions = self._text_revisions()
+            return
+        self._last_texts = (old_text, new_text)
 
-        old_cursor = self.old.editor.textCursor()
-        old_cursor.movePosition(QTextCursor.MoveOperation.Start)
+        self._diff_seq += 1
+        self._diff_revisions = self._text_revisions()
 
-        new_cursor = self.new.editor.textCursor()
-        new_cursor.movePosition(QTextCursor.MoveOperation.Start)
+        # Typing and undoing it again brings the texts back to equal,
+        # there is nothing to diff then, only the placeholders to show
+        if old_text == new_text:
+            self._apply_diff(self._diff_seq, [], [])
+            return
 
-        i = 0
-        while i < len(opcodes):
-            op, length = opcodes[i]
+        # Diffing big texts takes a while, don't freeze the GUI meanwhile
+        self._diff_pool.clear()  # Jobs still in the queue are outdated now
+        self._diff_pool.start(DiffJob(self._diff_seq, old_text, new_text, self.diffFinished))
 
-            is_modification = op == '-' and i + 1 < len(opcodes) and opcodes[i+1][0] == '+'
-            if is_modification:
-                old_highlights.append(self._one_diff_highlight(opcodes[i  ][1], self.DEL_COLOR, old_cursor))
-                new_highlights.append(self._one_diff_highlight(opcodes[i+1][1], self.ADD_COLOR, new_cursor))
-                i += 2
-                continue
+    def _text_revisions(self) -> tuple[int, int]:
+        return self.old.text_revision, self.new.text_revision
 
-            if op == '+':
-                new_highlights.append(self._one_diff_highlight(length, self.ADD_COLOR, new_cursor))
-            elif op == '-':
-                old_highlights.append(self._one_diff_highlight(length, self.DEL_COLOR, old_cursor))
-            elif op == '=':
-                old_cursor.movePosition(QTextCursor.NextCharacter, QTextCursor.MoveAnchor, length)
-                new_cursor.movePosition(QTextCursor.NextCharacter, QTextCursor.MoveAnchor, length)
-            i += 1
+    @Slot(int, object, object)
+    def _apply_diff(self, seq: int, old_ranges: list[list[int]], new_ranges: list[list[int]]):
+        # Either a newer diff is on the way, or the text was edited since and
+        # the edit scheduled one. The current highlights follow the edits,
+        # unlike the positions of an outdated result, so keep them instead
+        if seq != self._diff_seq:
+            return
+        if self._text_revisions() != self._diff_revisions:
+            # The texts may be edited back to these ones by the time the
+            # scheduled update runs, which must not take them as diffed then
+            self._last_texts = None
+            return
 
-        # Get placeholder highlights and combine them with diff highlights
-        old_placeholder_highlights = self._get_placeholder_highlights(self.old)
-        new_placeholder_highlights = self._get_placeholder_highlights(self.new)
+        old_highlights = self._diff_highlights(self.old, old_ranges, self._del_format)
+        new_highlights = self._diff_highlights(self.new, new_ranges, self._add_format)
 
-        self.old.apply_highlights(old_highlights + old_placeholder_highlights)
-        self.new.apply_highlights(new_highlights + new_placeholder_highlights)
+        # Combine them with the placeholder highlights made on the last
+        # change of the placeholders
+        self.old.apply_highlights(old_highlights + self._placeholder_highlights[self.old])
+        self.new.apply_highlights(new_highlights + self._placeholder_highlights[self.new])
 
     @Slot(int)
     def expand_section(self, index):
-        if 0 <= index < len(self.collapsed_sections):
+        if 0 <= index < len(self.collapsed_sections) and self.collapsed_sections[index] is not None:
             self._expand_section(index)
 
     def _expand_section(self, index):
-        original_lines = self.collapsed_sections[index]
-        text_to_insert = "".join(original_lines)
+        text_to_insert, _ = self.collapsed_sections[index]
 
         for editor in [self.old.editor, self.new.editor]:
-            doc = editor.document()
-            block = doc.firstBlock()
-            while block.isValid():
-                if block.userState() == index + 1:
-                    cursor = QTextCursor(block)
-                    cursor.beginEditBlock()
-
-                    # Select entire block including newline character
-                    cursor.movePosition(QTextCursor.StartOfBlock)
-                    cursor.movePosition(QTextCursor.EndOfBlock, QTextCursor.KeepAnchor)
-                    cursor.movePosition(QTextCursor.NextCharacter, QTextCursor.KeepAnchor)  # Include newline
-
-                    # Replace with original content
-                    cursor.removeSelectedText()
-                    cursor.insertText(text_to_insert)
-                    cursor.endEditBlock()
-                    break
-                block = block.next()
-
-        # Remove the expanded section and update remaining userStates
-        del self.collapsed_sections[index]
-        for editor in [self.old.editor, self.new.editor]:
-            doc = editor.document()
-            block = doc.firstBlock()
-            while block.isValid():
-                state = block.userState()
-                if state > index + 1:
-                    block.setUserState(state - 1)
-                block = block.next()
+            placeholder_cursor = editor.remove_placeholder(index)
+            if placeholder_cursor is not None:
+                block = placeholder_cursor.block()
+                # Select entire block including newline character, which
+                # the length of a block counts in
+                start = block.position()
+                end = min(start + block.length(), editor.document().characterCount() - 1)
+
+                # Replace with original content, inserting over the selection
+                # removes it as part of the same edit
+                cursor = QTextCursor(block)
+                cursor.setPosition(end, QTextCursor.KeepAnchor)
+                cursor.insertText(text_to_insert)
+
+        # Collapse indices stay valid for the other placeholders, so their
+        # userStates are left alone instead of renumbering the documents
+        self.collapsed_sections[index] = None
+        self._refresh_placeholder_highlights()
         self.update_diff()
 
 
@@ -648,11 +1350,12 @@ def main(argv: list[str] = sys.argv):
     signal.signal(signal.SIGINT, signal.SIG_DFL)  # handle CTRL-C
 
     app = QApplication(argv)
-    if DARK_STYLE_SHEET:
-        app.setStyleSheet(DARK_STYLE_SHEET)
+    style_sheet = load_style_sheet()
+    if style_sheet:
+        app.setStyleSheet(style_sheet)
 
     # Set default texts and lexer
-    old_text, new_text, lexer = OLD_TEXT, NEW_TEXT, PythonLexer()
+    old_text, new_text, lexer = OLD_TEXT, NEW_TEXT, _get_lexer("python")
 
     if len(argv) == 3:
         file1_path = Path(argv[1])
@@ -663,13 +1366,13 @@ def main(argv: list[str] = sys.argv):
 
         try:
             # Guess lexer from the second file's extension
-            lexer = get_lexer_for_filename(file2_path.name, stripall=True)
+            lexer = _get_lexer_for_filename(file2_path.name)
         except Exception:  # pygments.util.ClassNotFound
             print(
                 f"Warning: Could not find a lexer for '{file2_path.name}'. Falling back to plain text.",
                 file=sys.stderr,
             )
-            lexer = TextLexer()
+            lexer = _get_lexer("text")
 
     window = MainWindow(old_text, new_text, lexer)
     window.show()
@@ -683,6 +1386,5 @@ if __name__ == "__main__":
 
 # TODO: guess the language
 # TODO: add the spacers
-# TODO: make calculating diff not blocking for gui
 # TODO: highlight the line that partially changed
 # XXX: since you cannot collapse back, add reload button to reset the view completely???
@@ -18,9 +18,19 @@ EQUAL   = Tag.EQUAL
 # SYNCH   = Tag.SYNCH
 COUNT   = Tag.COUNT
 
+# Same characters as difflib.IS_CHARACTER_JUNK, but its __contains__ is
+# called as the isjunk callback directly, without a Python frame
+_JUNK = frozenset(" \t")
+
 
 class SequenceMatcher(difflib.SequenceMatcher):
     REFINE_CUTOFF = 0.75
+    # Blocks with more line pairs than this are left as a plain replace.
+    # The search is quadratic and recurses, and a synch line found in a
+    # block that big rarely makes the diff any easier to read. The bound is
+    # high enough to leave the refinement of typical edits as it was, and
+    # mdiff already shows a replace as its lines paired one to one
+    REFINE_MAX_PAIRS = 200 * 200
 
     def generate_opcodes(self, refine: bool = False):
         i = j = 0
@@ -31,7 +41,7 @@ class SequenceMatcher(difflib.SequenceMatcher):
             elif j < bj:          tag = INSERT
 
             if refine and tag == REPLACE:
-                yield from self._refine_replace_block(i, ai, j, bj)
+                yield from self._refine_replace_block(i, ai, j, bj, {})
             elif tag != COUNT:
                 yield (tag, i, ai, j, bj)
 
@@ -39,10 +49,14 @@ class SequenceMatcher(difflib.SequenceMatcher):
             if size:
                 yield (EQUAL, ai, i, bj, j)
 
-    def _refine_replace_block(self, i1, i2, j1, j2):
+    def _refine_replace_block(self, i1, i2, j1, j2, ratios):
         """
         A generator that recursively refines a 'REPLACE' block by operating
         on its indices, closely following the logic of `difflib.Differ._fancy_replace`.
+
+        `ratios` maps the (i, j) pairs already scored to their ratio. The
+        blocks around a synch point are parts of the current one, so the
+        recursion would otherwise score the same pairs over again.
         """
 
         # Base cases for recursion
@@ -52,6 +66,9 @@ class SequenceMatcher(difflib.SequenceMatcher):
         if j1 >= j2:
             if i1 < i2: yield (DELETE, i1, i2, j1, j1)
             return
+        if (i2 - i1) * (j2 - j1) > self.REFINE_MAX_PAIRS:
+            yield (REPLACE, i1, i2, j1, j2)
+            return
 
         # don't synch up unless the lines have a similarity score of at
         # least cutoff; best_ratio tracks the best score seen so far
@@ -60,23 +77,37 @@ class SequenceMatcher(difflib.SequenceMatcher):
         eqi, eqj = None, None   # 1st indices of equal lines (if any)
 
         # Create a single line-cruncher to be reused
-        line_cruncher = difflib.SequenceMatcher(isjunk=difflib.IS_CHARACTER_JUNK)
+        line_cruncher = difflib.SequenceMatcher(isjunk=_JUNK.__contains__)
+
+        # Index the lines of the block once, so that only the lines which
+        # have an identical counterpart compare strings in the loop below
+        a, b = self.a, self.b
+        a_lines = set(a[i1:i2])
 
         # Search for the best matching pair
         for j in range(j1, j2):
-            line_cruncher.set_seq2(self.b[j])
+            b_line = b[j]
+            b_len = len(b_line)
+            has_identical = b_line in a_lines
+            line_cruncher.set_seq2(b_line)
             for i in range(i1, i2):
-                if self.a[i] == self.b[j]:
+                if has_identical and a[i] == b_line:
                     if eqi is None:
                         eqi, eqj = i, j
                     continue
-                line_cruncher.set_seq1(self.a[i])
-
-                if line_cruncher.real_quick_ratio() <= best_ratio:
-                    continue
-                if line_cruncher.quick_ratio() <= best_ratio:
-                    continue
-                ratio = line_cruncher.ratio()
+                ratio = ratios.get((i, j))
+                if ratio is None:
+                    # real_quick_ratio, without loading the line into the
+                    # cruncher. Two empty lines would be identical, so the
+                    # lengths don't add up to zero here
+                    a_len = len(a[i])
+                    if 2.0 * min(a_len, b_len) / (a_len + b_len) <= best_ratio:
+                        continue
+                    line_cruncher.set_seq1(a[i])
+
+                    if line_cruncher.quick_ratio() <= best_ratio:
+                        continue
+                    ratio = ratios[i, j] = line_cruncher.ratio()
                 if ratio > best_ratio:
                     best_ratio, best_i, best_j = ratio, i, j
 
@@ -97,7 +128,7 @@ class SequenceMatcher(difflib.SequenceMatcher):
 
 
         # 1. Yield the refined opcodes for the block *before* the synch point
-        yield from self._refine_replace_block(i1, best_i, j1, best_j)
+        yield from self._refine_replace_block(i1, best_i, j1, best_j, ratios)
 
         # 2. Yeild the synch line itself
         if eqi is None:
@@ -106,7 +137,7 @@ class SequenceMatcher(difflib.SequenceMatcher):
             yield EQUAL, best_i, best_i + 1, best_j, best_j + 1
 
         # 3. Yield the refined opcodes for the block *after* the synch point
-        yield from self._refine_replace_block(best_i + 1, i2, best_j + 1, j2)
+        yield from self._refine_replace_block(best_i + 1, i2, best_j + 1, j2, ratios)
 
 
 def _get_intra_line_opcodes(from_line, to_line):
@@ -1,7 +1,4 @@
-import difflib
 import my_diff_lib
-import webbrowser
-import os
 import sys
 
 prefix = "adf\n"*15
@@ -50,83 +47,106 @@ YELLOW_BG = "\033[43m"
 RED_FG = "\033[91m"
 GREEN_FG = "\033[92m"
 RESET = "\033[0m"
+_PAD50 = " " * 50
 
+# The rows of both renderings are written out at once at the end, print
+# would go through stdout per row
+rows = []
 for n1, n2, changed in my_diff_lib.mdiff(lines1, lines2):
     p1 = RED_BG if changed else ""
-    s1 = (n1 or "").ljust(50)
+    t1 = n1 or ""
+    s1 = t1 if len(t1) >= 50 else t1 + _PAD50[len(t1):]
     s1 = p1 + s1 if n1 is not None else YELLOW_BG + s1
 
     p2 = GREEN_BG if changed else ""
-    s2 = (n2 or "").ljust(50)
+    t2 = n2 or ""
+    s2 = t2 if len(t2) >= 50 else t2 + _PAD50[len(t2):]
     s2 = p2 + s2 if n2 is not None else YELLOW_BG + s2
 
     # similar = False
+    # (needs difflib imported again)
     # s = list(SequenceMatcher(isjunk=difflib.IS_CHARACTER_JUNK, a=n1, b=n2).generate_opcodes())
     # intra = my_diff_lib._get_intra_line_opcodes(n1, n2) if similar else []
-    print(f"{s1}{RESET}|{s2}{RESET}")
+    rows.append(f"{s1}{RESET}|{s2}{RESET}\n")
 
 
 import fast_diff_match_patch
 
 
 opcodes = fast_diff_match_patch.diff(text1, text2, timelimit=0.1, checklines=True, counts_only=False)
-print(opcodes)
+rows.append(f"{opcodes}\n")
 
 
 def generate_side_by_side_lines(opcodes):
     """
     A generator that takes character-level opcodes from fast_diff_match_patch
      and yields pairs of completed, colored, side-by-side lines.
+
+    Yields: (left_line, left_visible_len, right_line, right_visible_len)
     """
     left_line_parts = []
     right_line_parts = []
+    # Visible lengths are counted as the parts come in, the colored lines
+    # don't need to be scanned for escape codes afterwards
+    left_vlen = 0
+    right_vlen = 0
 
     for kind, text in opcodes:
-        # Split the text by newlines. The parts list will contain the content
-        # between newlines. The number of newlines is len(parts) - 1.
-        parts = text.split('\n')
+        # Scan for the newlines instead of splitting on them, most texts
+        # have none and would be copied into a list of one for nothing
+        start = 0
+        while True:
+            end = text.find('\n', start)
+            part = text[start:] if end == -1 else text[start:end]
 
-        for i, part in enumerate(parts):
             # If the part is not empty, add it to the correct column(s)
             if part:
                 if kind == '=':
                     left_line_parts.append(part)
                     right_line_parts.append(part)
+                    left_vlen += len(part)
+                    right_vlen += len(part)
                 elif kind == '-':
                     left_line_parts.append(f"{RED_BG}{part}{RESET}")
+                    left_vlen += len(part)
                 elif kind == '+':
                     right_line_parts.append(f"{GREEN_BG}{part}{RESET}")
+                    right_vlen += len(part)
+
+            if end == -1:
+                break
 
-            # If this is not the last part, it means a newline was here.
-            # This completes a line, so we yield the result and reset.
-            if i < len(parts) - 1:
-                yield ("".join(left_line_parts), "".join(right_line_parts))
-                left_line_parts = []
-                right_line_parts = []
+            # A newline was here. This completes a line, so we yield the
+            # result and reset.
+            yield ("".join(left_line_parts), left_vlen, "".join(right_line_parts), right_vlen)
+            # Only the joined lines leave the generator, the lists can be reused
+            left_line_parts.clear()
+            right_line_parts.clear()
+            left_vlen = 0
+            right_vlen = 0
+            start = end + 1
 
     # After the loop, there might be a final, non-terminated line. Yield it.
     if left_line_parts or right_line_parts:
-        yield ("".join(left_line_parts), "".join(right_line_parts))
+        yield ("".join(left_line_parts), left_vlen, "".join(right_line_parts), right_vlen)
 
 
 LINE_WIDTH = 50
 EMPTY_LINE = " "*LINE_WIDTH
-for left_line, right_line in generate_side_by_side_lines(opcodes):
-    # Pad strings that have ANSI codes correctly by calculating visible length
-    def visible_len(s):
-        return len(s) - (s.count(RESET) * (len(RED_BG) + len(RESET)))
-
+for left_line, left_vlen, right_line, right_vlen in generate_side_by_side_lines(opcodes):
     # Fallback for simple cases where one side is completely empty
     if left_line is None:
         left_display = f"{YELLOW_BG}{EMPTY_LINE}{RESET}"
     else:
-        padding = " " * (LINE_WIDTH - visible_len(left_line))
+        # Pad strings that have ANSI codes correctly by their visible length
+        padding = " " * (LINE_WIDTH - left_vlen)
         left_display = f"{left_line}{padding}"
 
     if right_line is None:
         right_display = f"{YELLOW_BG}{EMPTY_LINE}{RESET}"
     else:
-        padding = " " * (LINE_WIDTH - visible_len(right_line))
+        padding = " " * (LINE_WIDTH - right_vlen)
         right_display = f"{right_line}{padding}"
 
-    print(f"{left_display}|{right_display}")
+    rows.append(f"{left_display}|{right_display}\n")
+sys.stdout.write("".join(rows))